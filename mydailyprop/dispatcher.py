@@ -0,0 +1,45 @@
+"""Dispatch of the graph events streamed to the app.
+
+It runs for every streamed token: it is fully typed and free of Reflex and
+LangChain imports so that it can be compiled with mypyc (see the README),
+the pure Python module being used otherwise.
+"""
+
+from typing import Any, Container, Dict, List, Mapping, Optional
+
+# node extracting the Editorial's contents
+EDITORIAL_NODE = "get_contents"
+
+
+def dispatch_event(
+    event: Mapping[str, Any],
+    buffers: Dict[str, List[str]],
+    finished_nodes: List[str],
+    streamed_nodes: Container[str],
+) -> Optional[str]:
+    """Buffer the tokens streamed by the nodes of the graph.
+
+    The streamed nodes whose model call finishes are added to
+    finished_nodes. Returns the markdown of the extracted Editorial when the
+    event carries it, None otherwise.
+    """
+    kind: str = event["event"]
+    # emitted for each streamed token
+    if kind == "on_chat_model_stream":
+        content: str = event["data"]["chunk"].content
+        # only keep non-empty content (not tool calls)
+        if content:
+            origin_node: str = event["metadata"]["langgraph_node"]
+            if origin_node in streamed_nodes:
+                buffers.setdefault(origin_node, []).append(content)
+    # emitted when a model call finishes
+    elif kind == "on_chat_model_end":
+        origin_node = event["metadata"]["langgraph_node"]
+        if origin_node in streamed_nodes:
+            finished_nodes.append(origin_node)
+    # emitted when a node returns: the Editorial was already validated and
+    # formatted by the node, no need to validate its extraction again
+    elif kind == "on_chain_end" and event["name"] == EDITORIAL_NODE:
+        markdown: str = event["data"]["output"]["editorial_markdown"]
+        return markdown
+    return None
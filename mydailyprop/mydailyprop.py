@@ -1,65 +1,91 @@
 """My Daily Propaganda App."""
 
-from enum import Enum
+import asyncio
+from functools import cached_property
+import hashlib
 from operator import add
 import os
-from typing import Annotated, Any, AsyncGenerator, Dict, List
-from pydantic import BaseModel, Field
+from pathlib import Path
+import re
+import time
+from typing import (
+    Annotated, Any, AsyncGenerator, Dict, List, Optional, Self, Union)
+from urllib.parse import urlsplit, urlunsplit
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing_extensions import TypedDict
+import diskcache  # type: ignore
+import httpx
+import orjson
+import tiktoken
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
 from langgraph.graph import StateGraph
 from langchain_openai import ChatOpenAI
-from langchain import hub
+from langchain_core.load import dumps, loads
 from langchain_community.document_loaders import FireCrawlLoader
 import reflex as rx  # type: ignore
 # Reflex does not provide type hints at the moment
+from reflex.event import EventSpec  # type: ignore
+from reflex.state import StateUpdate  # type: ignore
+from .dispatcher import dispatch_event
 
 model_name = "gpt-4o-mini"
-model = ChatOpenAI(model=model_name, temperature=0.7, streaming=True)
-
-
-class NewsOutlet(str, Enum):
-    LEMONDE = (
-        "Le Monde",
-        """Le Monde is a French daily newspaper.
+# keep-alive connections shared by all the model calls, each graph run reuses
+# the connections (and TLS sessions) of the previous ones, and HTTP/2
+# multiplexes the concurrent calls of the graph over a single connection
+_http_limits = httpx.Limits(
+    max_keepalive_connections=32,
+    max_connections=64,
+    keepalive_expiry=85.0)
+_http_client = DefaultHttpxClient(limits=_http_limits, http2=True)
+_http_async_client = DefaultAsyncHttpxClient(limits=_http_limits, http2=True)
+model = ChatOpenAI(
+    model=model_name,
+    temperature=0.7,
+    # same sampling for the same prompts, as far as OpenAI honours the seed
+    # (best effort, runs are not guaranteed to be reproducible)
+    seed=42,
+    streaming=True,
+    http_client=_http_client,
+    http_async_client=_http_async_client)
+
+cache_dir = Path(
+    os.getenv("MYDAILYPROP_CACHE_DIR") or "~/.cache/mydailyprop"
+).expanduser()
+
+
+LEMONDE = "Le Monde"
+THEGUARDIAN = "The Guardian"
+LIBERATION = "Libération"
+
+# editorial context of each supported outlet, handed to the critique
+OUTLET_CONTEXTS: dict[str, str] = {
+    LEMONDE: """Le Monde is a French daily newspaper.
 It publishes a daily editorial that is signed 'Le Monde'.
 Not signed because it represents the views of the entire newspaper, the \
 editorial is typically written by one of the four editorial writers of the \
 editorial team after a collective process of selecting and taking a stance on \
-a current issue."""
-    )
-    THEGUARDIAN = (
-        "The Guardian",
-        """The Guardian is a British daily newspaper.
+a current issue.""",
+    THEGUARDIAN: """The Guardian is a British daily newspaper.
 It publishes two daily editorial pieces titled 'The Guardian view on...', \
 which are both unsigned.
 Though the piece is written mainly by a single author, it is produced through \
 a collaborative process involving other journalists, subject specialists, and \
 the editor, ensuring that the final unsigned piece reflects a collective \
-viewpoint rather than individual opinions."""
-    )
-    LIBERATION = (
-        "Libération",
-        """Libération is a French daily newspaper.
+viewpoint rather than individual opinions.""",
+    LIBERATION: """Libération is a French daily newspaper.
 It publishes a daily editorial that is signed by a member of the editorial \
-board (may be the director)."""
-    )
-
-    def __new__(cls, value, editorial_context):
-        obj = str.__new__(cls, value)
-        obj._value_ = value
-        obj._editorial_context = editorial_context
-        return obj
-
-    @property
-    def contextualize(self):
-        return self._editorial_context
+board (may be the director).""",
+}
 
 
 class Editorial(BaseModel):
+    # immutable, the markdown built from the fields can be cached
+    model_config = ConfigDict(frozen=True)
+
     title: str = Field(
         ...,
         title="Editorial title")
-    outlet: NewsOutlet = Field(
+    outlet: str = Field(
         ...,
         title="Outlet the editorial was published in")
     date: str = Field(
@@ -75,15 +101,39 @@ class Editorial(BaseModel):
         ...,
         title="Editorial body")
 
-    def markdown(self) -> str:
-        return f"# {self.title} ({self.outlet.value}, {self.date} - \
+    @field_validator("outlet")
+    @classmethod
+    def _check_outlet(cls, outlet: str) -> str:
+        if outlet not in OUTLET_CONTEXTS:
+            raise ValueError(f"unsupported outlet: {outlet!r}")
+        return outlet
+
+    @cached_property
+    def markdown_text(self) -> str:
+        # built once per editorial, every prompt gets the exact same string
+        return f"# {self.title} ({self.outlet}, {self.date} - \
         {self.language})\n\n**{self.lede}**\n\n{self.body}"
 
+    def markdown(self) -> str:
+        return self.markdown_text
+
+    def model_copy(
+        self,
+        *,
+        update: Dict[str, Any] | None = None,
+        deep: bool = False
+    ) -> Self:
+        copy = super().model_copy(update=update, deep=deep)
+        # the markdown of the copy is built again from its own fields
+        copy.__dict__.pop("markdown_text", None)
+        return copy
+
 
 class GraphState(TypedDict):
 
     url:                    str
     editorial:              Editorial
+    editorial_markdown:     str
     news_critique:          str
     psychological_analysis: str
     propaganda_synthesis:   Annotated[str, add]
@@ -93,42 +143,152 @@ class GraphState(TypedDict):
     # psychological_analysis)
 
 
+# prompts not pinned to a commit are pulled again after a day
+_PROMPT_CACHE_TTL = 24 * 60 * 60
+
+
+def _pull_prompt(prompt_ref: str) -> Any:
+    """Pull a prompt from the LangSmith hub, through a local cache.
+
+    Prompts pinned to a commit ('owner/name:commit') never change and are
+    pulled only once, saving the hub round trips at every app start.
+    """
+    path = cache_dir / "prompts" / (
+        prompt_ref.replace("/", "_").replace(":", "_") + ".json")
+    if path.exists() and (
+        ":" in prompt_ref
+        or time.time() - path.stat().st_mtime < _PROMPT_CACHE_TTL
+    ):
+        return loads(path.read_text())
+
+    # only needed when the prompt is not cached yet
+    from langchain import hub
+
+    prompt = hub.pull(prompt_ref)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # written aside then moved, concurrent workers never read partial files
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(dumps(prompt))
+    tmp_path.replace(path)
+    return prompt
+
+
 # 'get_contents' Node
-_get_contents_prompt = hub.pull("bse-guirriecp/mydailyprop-get_contents:1b432aae")
+_get_contents_prompt_ref = "bse-guirriecp/mydailyprop-get_contents:1b432aae"
+_get_contents_prompt = _pull_prompt(_get_contents_prompt_ref)
 _get_contents_chain = _get_contents_prompt | model
 
 
-def _get_contents(state: GraphState) -> dict[str, Any]:
+# the scrape waits for the warm-up, which must never cost more than it saves
+_WARM_UP_TIMEOUT = httpx.Timeout(2.0)
+
+
+async def _warm_up_model_connection() -> None:
+    """Open the connection to the OpenAI API while the page is scraped."""
+    try:
+        await _http_async_client.head(
+            model.openai_api_base or "https://api.openai.com/v1",
+            timeout=_WARM_UP_TIMEOUT)
+    except httpx.HTTPError:
+        # the model calls will open their own connection
+        pass
+
+
+# maximum number of tokens of the scraped page sent to the model, or of
+# characters (about 4 per token) when the encoding is not available
+_PAGE_MAX_TOKENS = 8192
+_PAGE_MAX_CHARS = 4 * _PAGE_MAX_TOKENS
+
+
+def _load_encoding() -> Optional[tiktoken.Encoding]:
+    """Load the tokenizer of the model, None if it can not be downloaded."""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except (OSError, ValueError, KeyError):
+        # requests errors are OSErrors, hash mismatches ValueErrors and
+        # unknown models KeyErrors
+        return None
+
+
+# loaded (and downloaded on the first start) at import rather than during a
+# run, where the download would block the event loop
+_encoding = _load_encoding()
+
+
+_HTML_TAG = re.compile(r"</?[A-Za-z][A-Za-z0-9-]*(?:[\s/][^>\n]*)?>")
+
+
+def _clean_page(page: str) -> str:
+    """Strip the scraped page of what only costs input tokens."""
+    # html tag leftovers, a tag name followed by its attributes or the end of
+    # the tag: markdown autolinks and plain '<' or '>' are kept
+    page = _HTML_TAG.sub("", page)
+    # whitespaces, keeping the paragraphs
+    page = re.sub(r"[ \t\r\f\v]+", " ", page)
+    page = re.sub(r" ?\n[ \n]*\n ?", "\n\n", page).strip()
+    if _encoding is None:
+        return page[:_PAGE_MAX_CHARS]
+    tokens = _encoding.encode(page)
+    if len(tokens) > _PAGE_MAX_TOKENS:
+        page = _encoding.decode(tokens[:_PAGE_MAX_TOKENS])
+    return page
+
+
+async def _get_contents(state: GraphState) -> dict[str, Any]:
     loader = FireCrawlLoader(
         api_key=os.getenv('FIRECRAWL_API_KEY'),
         url=state["url"],
-        mode="scrape"
+        mode="scrape",
+        # firecrawl-py 0.0.20 scrapes through the v0 API, where the markdown
+        # is returned by default and the main contents only is a page option
+        params={"pageOptions": {"onlyMainContent": True}}
     )
-    docs = loader.load()
-    extracted_json_data = docs[0].page_content
+    docs, _ = await asyncio.gather(
+        loader.aload(),
+        _warm_up_model_connection())
+    extracted_json_data = _clean_page(docs[0].page_content)
 
-    editorial_dict = _get_contents_chain.invoke({
+    editorial_dict = await _get_contents_chain.ainvoke({
         "json_data": extracted_json_data, }
     )
     editorial = Editorial.model_validate(editorial_dict)
 
+    # formatted once, the three analysis prompts share the exact same text
     return {
         "editorial": editorial,
+        "editorial_markdown": editorial.markdown(),
     }
 
 
+# The 'critique', 'psychological' and 'synthesis' prompts all receive the
+# same editorial markdown. OpenAI caches identical prompt prefixes (from 1024
+# tokens) matched from the first token: the three prompts only share that
+# prefix if they start with the editorial, before their own instructions and
+# variables. The pinned hub prompts do not, the templates of the next pin bump
+# have to put the editorial first.
+
+# output tokens are bounded per node, a runaway generation can not hold the
+# synthesis (and the whole run) back
+_MAX_TOKENS = {
+    "critique":         800,
+    "psychological":    800,
+    "synthesis":        1200,
+}
+
 # 'critique' Node
-_critique_prompt = hub.pull("bse-guirriecp/mydailyprop-critique:6cfa7e63")
-_critique_chain = _critique_prompt | model
+_critique_prompt_ref = "bse-guirriecp/mydailyprop-critique:6cfa7e63"
+_critique_prompt = _pull_prompt(_critique_prompt_ref)
+_critique_chain = _critique_prompt | model.bind(
+    max_tokens=_MAX_TOKENS["critique"])
 
 
-def _critique(state: GraphState) -> dict[str, Any]:
+async def _critique(state: GraphState) -> dict[str, Any]:
     edito = state["editorial"]
-    critique = _critique_chain.invoke({
+    critique = await _critique_chain.ainvoke({
         "news_outlet":          edito.outlet,
         "editorial_date":       edito.date,
-        "editorial_context":    edito.outlet.contextualize,
-        "editorial_content":    edito.markdown(),
+        "editorial_context":    OUTLET_CONTEXTS[edito.outlet],
+        "editorial_content":    state["editorial_markdown"],
     })
     return {
         "news_critique": critique.content
@@ -136,13 +296,15 @@ def _critique(state: GraphState) -> dict[str, Any]:
 
 
 # 'psychological' Node
-_psychological_prompt = hub.pull("bse-guirriecp/mydailyprop-psychological:6e8ed776")
-_psychological_chain = _psychological_prompt | model
+_psychological_prompt_ref = "bse-guirriecp/mydailyprop-psychological:6e8ed776"
+_psychological_prompt = _pull_prompt(_psychological_prompt_ref)
+_psychological_chain = _psychological_prompt | model.bind(
+    max_tokens=_MAX_TOKENS["psychological"])
 
 
-def _psychological(state: GraphState) -> dict[str, Any]:
-    psychological = _psychological_chain.invoke({
-        "editorial":    state["editorial"].markdown(),
+async def _psychological(state: GraphState) -> dict[str, Any]:
+    psychological = await _psychological_chain.ainvoke({
+        "editorial":    state["editorial_markdown"],
         "date":         state["editorial"].date, }
     )
     return {
@@ -151,13 +313,15 @@ def _psychological(state: GraphState) -> dict[str, Any]:
 
 
 # 'synthesis' Node
-_synthesis_prompt = hub.pull("bse-guirriecp/mydailyprop-synthesis:59eb6122")
-_synthesis_chain = _synthesis_prompt | model
+_synthesis_prompt_ref = "bse-guirriecp/mydailyprop-synthesis:59eb6122"
+_synthesis_prompt = _pull_prompt(_synthesis_prompt_ref)
+_synthesis_chain = _synthesis_prompt | model.bind(
+    max_tokens=_MAX_TOKENS["synthesis"])
 
 
-def _synthesis(state: GraphState) -> dict[str, Any]:
-    synthesis = _synthesis_chain.invoke({
-        "editorial":        state["editorial"].markdown(),
+async def _synthesis(state: GraphState) -> dict[str, Any]:
+    synthesis = await _synthesis_chain.ainvoke({
+        "editorial":        state["editorial_markdown"],
         "date":             state["editorial"].date,
         "critique":         state["news_critique"],
         "psychological":    state["psychological_analysis"]}
@@ -172,12 +336,20 @@ graph_builder = StateGraph(GraphState)
 graph_builder.add_node("get_contents", _get_contents)
 graph_builder.set_entry_point("get_contents")
 
+# 'critique' and 'psychological' stay two separate model calls: they run
+# concurrently over the same HTTP/2 connection, each streams its own card,
+# a single structured output call would stream tool call arguments instead
+# of the cards contents, and their prompts are versioned separately in the
+# hub
 graph_builder.add_node("critique", _critique)
 graph_builder.add_edge("get_contents", "critique")
 
 graph_builder.add_node("psychological", _psychological)
 graph_builder.add_edge("get_contents", "psychological")
 
+# 'synthesis' waits for both analyses: its prompt is sent in one go and can not
+# be fed their tokens as they come, starting it earlier would synthesize
+# truncated analyses
 graph_builder.add_node("synthesis", _synthesis)
 graph_builder.add_edge(["critique", "psychological"], "synthesis")
 
@@ -185,6 +357,58 @@ graph_builder.set_finish_point("synthesis")
 
 graph = graph_builder.compile()
 
+# query parameters only used to track the readers
+_TRACKING_PARAMS = re.compile(r"^(utm_|fbclid$|gclid$|mc_cid$|mc_eid$|ref$)")
+_DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+
+def _canonicalize(url: str) -> str:
+    """Canonical form of an URL: the same page always gets the same URL.
+
+    The canonical URL is also the one scraped: the query parameters are only
+    filtered and reordered, never decoded and encoded again.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    # only the host is case insensitive, not the user info
+    host = parts.netloc.rpartition("@")[2]
+    user_info = parts.netloc[:len(parts.netloc) - len(host)]
+    default_port = _DEFAULT_PORTS.get(scheme)
+    if default_port and host.endswith(default_port):
+        host = host[:-len(default_port)]
+    # sorted by key only, the values of a repeated key keep their order
+    query = "&".join(sorted(
+        (
+            segment for segment in parts.query.split("&")
+            if segment
+            and not _TRACKING_PARAMS.match(segment.partition("=")[0])
+        ),
+        key=lambda segment: segment.partition("=")[0]))
+    return urlunsplit(
+        (scheme, user_info + host.lower(), parts.path, query, ""))
+
+
+# Generated cards of previous runs, so that decrypting an already decrypted
+# URL replays the cards instead of scraping and prompting again. The key
+# includes the model, its generation settings and the prompt versions,
+# changing any of them invalidates the cached runs.
+_runs_cache = diskcache.Cache(cache_dir / "runs")
+
+
+def _run_cache_key(url: str) -> str:
+    return hashlib.sha256("\n".join((
+        url,
+        model_name,
+        f"temperature={model.temperature}",
+        f"seed={model.seed}",
+        f"max_tokens={sorted(_MAX_TOKENS.items())}",
+        _get_contents_prompt_ref,
+        _critique_prompt_ref,
+        _psychological_prompt_ref,
+        _synthesis_prompt_ref,
+    )).encode()).hexdigest()
+
+
 # Displays the graph LangGraph if 'SHOW_GRAPH' is true
 # in the environment variable
 if os.getenv("SHOW_GRAPH") == "true":
@@ -201,6 +425,51 @@ if os.getenv("SHOW_GRAPH") == "true":
     img.show()
 
 
+# description and color scheme of the cards streamed by the graph nodes
+_GENERATED_CARDS = {
+    "critique":         ("Journalistic evaluation (generated)", "indigo"),
+    "psychological":    ("Psychological analysis (generated)", "mint"),
+    "synthesis":        ("Propaganda synthesis (generated)", "crimson"),
+}
+# streamed tokens are sent to the frontend at most every 50ms
+_STREAM_FLUSH_INTERVAL = 0.05
+
+
+def _json_dumps(obj: Any, *, default: Any = None) -> str:
+    return orjson.dumps(
+        obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+# the state updates pushed to the frontend are serialized with orjson rather
+# than the (much slower) standard json module
+StateUpdate.__config__.json_dumps = _json_dumps
+
+
+# Streamed tokens do not go through the cards state var, which would send
+# the whole cards at every update: they are appended by a script to the
+# card on the frontend, and the card contents are stored in the state once
+# the node is done.
+_RESET_STREAMS_SCRIPT = "window.mydailypropStreams = {};"
+
+
+def _stream_script(card_name: str, chunk: str) -> str:
+    """Script appending a chunk of streamed tokens to a card."""
+    return (
+        "{"
+        "const streams = (window.mydailypropStreams ??= {});"
+        f"const card = {_json_dumps(card_name)};"
+        f"streams[card] = (streams[card] ?? '') + {_json_dumps(chunk)};"
+        # a new card may not be rendered yet: wait a few frames for it
+        "const write = (frames) => {"
+        "const element = document.getElementById('stream-' + card);"
+        "if (element) element.textContent = streams[card];"
+        "else if (frames > 0) requestAnimationFrame(() => write(frames - 1));"
+        "};"
+        "write(30);"
+        "}"
+    )
+
+
 class AppState(rx.State):  # type: ignore
     """The Reflex app state."""
 
@@ -215,74 +484,120 @@ class AppState(rx.State):  # type: ignore
         card_content: str,
         color_scheme: str
     ) -> None:
-        """Insert or update a card at the beginning of the cards dictionary."""
+        """Insert or update a card at the end of the cards dictionary.
+
+        The page shows the last card first. The cards already shown keep
+        their position (and their rendered elements) when a new one comes.
+        """
         if card_name in self.cards:
             self.cards[card_name]["content"] += card_content
         else:
-            new_dict_entry = {card_name: {
+            self.cards[card_name] = {
                 "desc": card_desc,
                 "content": card_content,
-                "color_scheme": color_scheme}}
-            self.cards = {**new_dict_entry, **self.cards}
+                "color_scheme": color_scheme}
 
-    async def decrypt(self) -> AsyncGenerator[None, None]:
+    def _stream_cards(
+        self,
+        buffers: Dict[str, List[str]],
+        texts: Dict[str, str]
+    ) -> List[EventSpec]:
+        """Send the buffered tokens to the generated cards on the frontend."""
+        scripts = []
+        for card_name, tokens in buffers.items():
+            if card_name not in self.cards:
+                # empty until finalized, the card shows the streamed tokens
+                card_desc, color_scheme = _GENERATED_CARDS[card_name]
+                self.upsert_card(
+                    card_name=card_name,
+                    card_desc=card_desc,
+                    card_content="",
+                    color_scheme=color_scheme)
+            chunk = "".join(tokens)
+            texts[card_name] = texts.get(card_name, "") + chunk
+            scripts.append(rx.call_script(_stream_script(card_name, chunk)))
+        buffers.clear()
+        return scripts
+
+    def _finalize_cards(
+        self,
+        card_names: List[str],
+        texts: Dict[str, str]
+    ) -> None:
+        """Store the whole streamed contents of the finished cards."""
+        for card_name in card_names:
+            if card_name in texts:
+                self.cards[card_name]["content"] = texts[card_name]
+        card_names.clear()
+
+    async def decrypt(
+        self
+    ) -> AsyncGenerator[Optional[Union[EventSpec, List[EventSpec]]], None]:
         """Decrypt the URL contents."""
 
         self.is_running = True
         # reset the cards
         self.cards = {}
-        yield
+        yield rx.call_script(_RESET_STREAMS_SCRIPT)
 
         # return if url is empty
         if not self.url:
             self.is_running = False
             return
 
+        # the same page is scraped and cached once, whatever the URL variant
+        url = _canonicalize(self.url)
+        cache_key = _run_cache_key(url)
+
+        # replay the cards of a previous run of the same URL, in the order
+        # they were generated and in a single update of the cards
+        cached_cards = _runs_cache.get(cache_key)
+        if cached_cards is not None:
+            for card in cached_cards:
+                self.upsert_card(
+                    card_name=card["name"],
+                    card_desc=card["desc"],
+                    card_content=card["content"],
+                    color_scheme=card["color_scheme"])
+            self.is_running = False
+            return
+
+        # tokens streamed since the last update of the frontend, by node
+        buffers: Dict[str, List[str]] = {}
+        # whole contents streamed by each node, and the nodes done streaming
+        texts: Dict[str, str] = {}
+        finished_nodes: List[str] = []
+        last_flush = time.monotonic()
+
         # invoke graph with the URL
         async for event in graph.astream_events(
-            {"url":  self.url},
+            {"url":  url},
             version="v2"
         ):
-            kind = event["event"]
-            # emitted for each streamed token
-            if kind == "on_chat_model_stream":
-                content = event["data"]["chunk"].content
-                # only print non-empty content (not tool calls)
-                if content:
-                    origin_node = event["metadata"]["langgraph_node"]
-                    if origin_node == "critique":
-                        self.upsert_card(
-                            card_name="critique",
-                            card_desc="Journalistic evaluation (generated)",
-                            card_content=content,
-                            color_scheme="indigo")
-                    elif origin_node == "psychological":
-                        self.upsert_card(
-                            card_name="psychological",
-                            card_desc="Psychological analysis (generated)",
-                            card_content=content,
-                            color_scheme="mint")
-                    elif origin_node == "synthesis":
-                        self.upsert_card(
-                            card_name="synthesis",
-                            card_desc="Propaganda synthesis (generated)",
-                            card_content=content,
-                            color_scheme="crimson")
-                    yield
-            # emitted when a model call finishes (we want to catch the
-            # Editorial's contents extraction as JSON using
-            # with_structured_output (using 'functions' / 'tools')
-            if kind == "on_chat_model_end":
-                # using 'functions' / 'tools' creates an event with tool_calls
-                if event["data"]["output"].tool_calls:
-                    edito_dict = event["data"]['output'].tool_calls[0]['args']
-                    self.upsert_card(
-                        card_name="editorial",
-                        card_desc="Editorial contents (extracted)",
-                        card_content=Editorial(**edito_dict).markdown(),
-                        color_scheme="blue")
-            yield
-
+            edito_markdown = dispatch_event(
+                event, buffers, finished_nodes, _GENERATED_CARDS)
+            if edito_markdown is not None:
+                self.upsert_card(
+                    card_name="editorial",
+                    card_desc="Editorial contents (extracted)",
+                    card_content=edito_markdown,
+                    color_scheme="blue")
+                yield None
+            # send the buffered tokens in batches rather than one by one
+            if finished_nodes or (buffers and time.monotonic() - last_flush
+                                  > _STREAM_FLUSH_INTERVAL):
+                scripts = self._stream_cards(buffers, texts)
+                self._finalize_cards(finished_nodes, texts)
+                last_flush = time.monotonic()
+                yield scripts
+        yield self._stream_cards(buffers, texts)
+        self._finalize_cards(list(texts), texts)
+
+        # in the order the cards were generated
+        _runs_cache.set(cache_key, [
+            {"name": card_name, **dict(card)}
+            for card_name, card in self.cards.items()
+        ])
         self.is_running = False
 
 
@@ -310,9 +625,20 @@ def content_card(card_contents: List[Any]) -> rx.Component:
                 color_scheme=card_contents[1]["color_scheme"],
                 size="3"
             ),
-            rx.markdown(
-                card_contents[1]["content"],
-                width="98%",
+            rx.cond(
+                card_contents[1]["content"] == "",
+                # filled by the streamed tokens until the card is finalized
+                rx.text(
+                    id="stream-" + card_contents[0].to(str),
+                    # never reused for another card's streamed text
+                    key=card_contents[0].to(str),
+                    white_space="pre-wrap",
+                    width="98%",
+                ),
+                rx.markdown(
+                    card_contents[1]["content"],
+                    width="98%",
+                ),
             ),
             type="always",
             scrollbars="vertical",
@@ -339,9 +665,16 @@ def index() -> rx.Component:
                 color_scheme="gray",
                 size="1",
             ),
-            rx.foreach(
-                AppState.cards,
-                content_card,
+            # last card first, without moving the cards already rendered
+            rx.flex(
+                rx.foreach(
+                    AppState.cards,
+                    content_card,
+                ),
+                direction="column-reverse",
+                spacing="5",
+                align="center",
+                width="100%",
             ),
             spacing="5",
             justify="center",